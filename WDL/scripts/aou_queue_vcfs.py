@@ -5,11 +5,13 @@ individual sample VCFs into the merged VCFs.
 
 import pandas as pd
 import argparse
+import io
 import subprocess, sys
 import re
 import os
-import gzip
 import multiprocessing
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 
 from tqdm import tqdm
 
@@ -18,9 +20,37 @@ try:
 except ImportError:
     subprocess.call([sys.executable, '-m', 'pip', 'install', 'gcsfs'])
 
+try:
+    from isal import igzip
+except ImportError:
+    subprocess.call([sys.executable, '-m', 'pip', 'install', 'isal'])
+    from isal import igzip
+
+
+# per-worker filesystem handle, set by _init_worker so sessions are reused across batches
+_FS = None
+
+# per-batch fields used by list_writer_core; a module-level namedtuple so rows can be pickled to workers
+BatchRow = namedtuple('BatchRow', ['vcf', 'sample_vcfs', 'merged_samples', 'sample_list_file', 'vcf_list_file', 'write_success'])
+
+# number of decompressed bytes to inflate at a time when searching for the #CHROM line
+HEADER_READ_SIZE = 1 << 20
+# number of compressed bytes fetched from GCS per read when searching for the #CHROM line
+HEADER_BLOCK_SIZE = 1 << 16
+# number of batch folders listed concurrently when collecting per-sample VCFs
+LIST_THREADS = 16
+
+# matches a per-sample VCF anywhere below a batch, capturing the batch folder (without gs://)
+_RE_VCF = re.compile(r'^(.+/)call-MitochondriaPipeline_v2_5/[^/]+/MitochondriaPipeline/[^/]+/call-LiftOverAfterSelf/(?:.+/)?out/[^/]+\.self\.ref\.split\.selfToRef\.final\.vcf$')
+_RE_PRE = re.compile(r'.+/(?=call-MergeMitoMultiSampleOutputsInternal)')
+_RE_ATTEMPT = re.compile(r'(?<=call-LiftOverAfterSelf/)attempt-(\d+)/(?=out/)')
+_RE_SUFFIX = re.compile(r'\.self\.ref\.split\.selfToRef\.final\.vcf$')
+# a complete #CHROM line in the raw (undecoded) header bytes
+_RE_CHROM = re.compile(rb'^#CHROM[^\n]*\n', re.MULTILINE)
+
 
 def generate_regex(merged_vcf_path):
-    this_search_pre = re.search('.+/(?=call-MergeMitoMultiSampleOutputsInternal)', merged_vcf_path)[0] 
+    this_search_pre = _RE_PRE.search(merged_vcf_path)[0]
     if len(this_search_pre) < 1:
         raise ValueError('ERROR: the regex search did not work.')
     this_search_str = this_search_pre + \
@@ -28,42 +58,114 @@ def generate_regex(merged_vcf_path):
     return this_search_str
 
 
-def get_vcf_paths(this_search_str, merged_path, fs):
-    run_out = subprocess.run(['gsutil', '-u', os.getenv("GOOGLE_PROJECT"), 'ls', this_search_str], stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
-    vcf_list_pre = [x for x in run_out.stdout.split('\n') if len(x) > 0]
-    sample_names_pre = [re.sub('.self.ref.split.selfToRef.final.vcf$', '', os.path.basename(x)) for x in vcf_list_pre]
+def list_vcfs_per_batch(fs, merged_vcf_paths):
+    """ Lists per-sample VCFs for all batches, with one recursive listing of each batch's
+    call-MitochondriaPipeline_v2_5/ folder issued concurrently, rather than one `gsutil ls`
+    per batch. Returns a list of gs:// VCF paths per merged VCF, in the same order as
+    merged_vcf_paths.
+    """
+    prefixes = [re.sub('^gs://', '', _RE_PRE.search(x)[0]) for x in merged_vcf_paths]
+    unique_prefixes = list(dict.fromkeys(prefixes))
+    with ThreadPoolExecutor(max_workers=LIST_THREADS) as ex:
+        listings = ex.map(lambda x: fs.find(x + 'call-MitochondriaPipeline_v2_5/'), unique_prefixes)
+        vcfs_by_prefix = {x: [] for x in unique_prefixes}
+        for prefix, listing in zip(unique_prefixes, listings):
+            for path in listing:
+                search = _RE_VCF.search(path)
+                if search and search[1] == prefix:
+                    vcfs_by_prefix[prefix].append('gs://' + path)
+    return [vcfs_by_prefix[x] for x in prefixes]
 
+
+def get_vcf_paths(vcf_list_pre, merged_path, merged_names):
     # edge case -- address cases where multiple attempts were successful by taking the latest one
     # example: shard-31, 7ca1cbb7-7c25-4683-825c-4a3522bba71c
-    attempt_count = []
+    best = {}
     for x in vcf_list_pre:
-        search = re.search('(?<=call-LiftOverAfterSelf/)attempt-([0-9]{1,})/(?=out/)', x)
+        search = _RE_ATTEMPT.search(x)
         this_att = int(search[1]) if search else 1
-        attempt_count.append(this_att)
-    df_attempts = pd.DataFrame({'sample': sample_names_pre, 'vcf': vcf_list_pre, 'attempt_number': attempt_count})
-    df_attempts_filt = df_attempts.iloc[df_attempts.groupby(['sample'])['attempt_number'].idxmax()].sort_index(axis=0)
-    vcf_list = list(df_attempts_filt['vcf'])
-    sample_names = [re.sub('.self.ref.split.selfToRef.final.vcf$', '', os.path.basename(x)) for x in vcf_list]
-
-    # confirm that all samples were identified
-    merged_names = get_sample_names_from_vcf(fs, merged_path)
-    if sorted(sample_names) != sorted(merged_names):
+        sample = _RE_SUFFIX.sub('', os.path.basename(x))
+        prev = best.get(sample)
+        if prev is None or prev[0] < this_att:
+            best[sample] = (this_att, x)
+    sample_names = list(best)
+    vcf_list = [vcf for _, vcf in best.values()]
+
+    # confirm that all samples were identified; sample_names is unique, so order-free set equality
+    # plus equal length is the same check as comparing the sorted lists
+    if len(sample_names) != len(merged_names) or set(sample_names) != set(merged_names):
         raise ValueError(f'ERROR: for {merged_path}, sample names from file paths are not identical to sample names from the merged VCF.')
     
     return pd.DataFrame({'sample': sample_names, 'vcf': vcf_list})
 
 
+class _BlockReader(io.RawIOBase):
+    """ Returns at most one block per read, so that the header scan only fetches
+    the compressed blocks it actually inflates.
+    """
+    def __init__(self, f, block_size):
+        self._f = f
+        self._block_size = block_size
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        data = self._f.read(min(len(b), self._block_size))
+        b[:len(data)] = data
+        return len(data)
+
+
+def _search_chrom_line(g, complete=True):
+    # the header is at the start of the file, so only inflate until the #CHROM line is complete.
+    # if complete is False, g is a truncated prefix and a line cut off at its end is not trusted.
+    buf = b''
+    while True:
+        chunk = g.read1(HEADER_READ_SIZE)
+        # terminate the last line at EOF so a trailing #CHROM line still matches
+        buf += chunk if chunk or not complete else b'\n'
+        search = _RE_CHROM.search(buf)
+        if search or not chunk:
+            return search
+
+
+def _sample_names_from_chrom_line(search):
+    if not search:
+        return []
+    return search[0].decode('utf-8').rstrip('\n').split('\t')[9:]
+
+
 def get_sample_names_from_vcf(fs, merged_path):
-    this_line = ''
-    with fs.open(merged_path, 'rb') as f:
-        g = gzip.GzipFile(fileobj=f)
-        for line in g:
-            line = line.decode('utf-8')
-            if re.search('^#CHROM', line):
-                this_line = line
-                break
-    this_line = re.sub(r'\n','',this_line)
-    return this_line.split('\t')[9:]
+    with fs.open(merged_path, 'rb', block_size=HEADER_BLOCK_SIZE, cache_type='none') as f:
+        search = _search_chrom_line(igzip.IGzipFile(fileobj=_BlockReader(f, HEADER_BLOCK_SIZE)))
+    return _sample_names_from_chrom_line(search)
+
+
+def get_sample_names_from_vcfs(fs, merged_paths):
+    """ Fetches the first block of every merged VCF concurrently through the gcsfs async
+    backend and parses the #CHROM line from it. Headers that do not fit in that block
+    fall back to a streamed read of the file.
+    """
+    n = len(merged_paths)
+    prefixes = fs.cat_ranges(merged_paths, [0] * n, [HEADER_BLOCK_SIZE] * n, on_error='return')
+    sample_names = []
+    for merged_path, data in zip(merged_paths, prefixes):
+        if isinstance(data, Exception):
+            # cat_ranges returns per-file errors in place of the data; re-read the file on its own
+            # so that the underlying error (e.g. FileNotFoundError) is raised with its path
+            sample_names.append(get_sample_names_from_vcf(fs, merged_path))
+            continue
+        try:
+            g = igzip.IGzipFile(fileobj=io.BytesIO(data))
+            search = _search_chrom_line(g, complete=len(data) < HEADER_BLOCK_SIZE)
+        except EOFError:
+            # the block ended mid-stream before the #CHROM line was complete
+            search = None
+        if search:
+            sample_names.append(_sample_names_from_chrom_line(search))
+        else:
+            sample_names.append(get_sample_names_from_vcf(fs, merged_path))
+    return sample_names
 
 
 def generate_output_paths(df, output_dir):
@@ -74,19 +176,28 @@ def generate_output_paths(df, output_dir):
     return df
 
 
-def produce_lists(df, overwrite):
-    for _, row in tqdm(df.iterrows()):
-        list_writer_core(overwrite=overwrite, row=row)
+def iter_batch_rows(df):
+    return map(BatchRow._make, df[list(BatchRow._fields)].itertuples(index=False, name=None))
 
 
-def list_writer_core(overwrite, row):
-    fs = gcsfs.GCSFileSystem(project=os.getenv('GOOGLE_PROJECT'))
-    if (overwrite) or (not fs.exists(row['write_success'])):
-        df_per_batch = get_vcf_paths(row['search_str'], row['vcf'], fs=fs)
-        df_per_batch['sample'].to_csv(row['sample_list_file'], sep='\t', index=False, header=False)
-        df_per_batch['vcf'].to_csv(row['vcf_list_file'], sep='\t', index=False, header=False)
-        with fs.open(row['write_success'], 'w') as f:
-            f.write('0\n')
+def filter_pending_batches(df, fs, output_dir):
+    # Lists the output folder once rather than checking each batch's _SUCCESS file separately
+    existing = {'gs://' + x for x in fs.find(output_dir)}
+    return df[~df.write_success.isin(existing)]
+
+
+def produce_lists(df, fs):
+    for row in tqdm(iter_batch_rows(df), total=df.shape[0]):
+        list_writer_core(row=row, fs=fs)
+
+
+def list_writer_core(row, fs):
+    df_per_batch = get_vcf_paths(row.sample_vcfs, row.vcf, merged_names=row.merged_samples)
+    # MergeVCFs.wdl reads the sample and VCF lists as separate files, so keep them split but upload
+    # both in one concurrent burst; _SUCCESS is written only once both lists exist
+    fs.pipe({row.sample_list_file: ''.join(x + '\n' for x in df_per_batch['sample']).encode(),
+             row.vcf_list_file: ''.join(x + '\n' for x in df_per_batch['vcf']).encode()})
+    fs.pipe_file(row.write_success, b'0\n')
 
 
 parser = argparse.ArgumentParser()
@@ -103,9 +214,13 @@ parser.add_argument('--serial', action='store_true',
 args = parser.parse_args()
 
 
+def _init_worker():
+    global _FS
+    _FS = gcsfs.GCSFileSystem(project=os.getenv('GOOGLE_PROJECT'))
+
+
 def _internal_list_writer(row):
-    _, row_this = row
-    return list_writer_core(overwrite=args.overwrite, row=row_this)
+    return list_writer_core(row=row, fs=_FS)
 
 
 if __name__ == "__main__":
@@ -115,16 +230,28 @@ if __name__ == "__main__":
     df['search_str'] = df.vcf.map(generate_regex)
     df = generate_output_paths(df, args.flat_file_output)
 
-    print(f'Generating per-batch files...')
-    if args.serial:
-        _ = produce_lists(df=df, overwrite=args.overwrite)
-    else:
-        multiprocessing.set_start_method('spawn')
-        num_cores = multiprocessing.cpu_count()
-        p = multiprocessing.Pool(processes=num_cores)
-        print(f'Using {str(num_cores)} cores...')
-        results = tqdm(p.imap(_internal_list_writer, df.iterrows()), total=df.shape[0])
-        tuple(results)
+    fs = gcsfs.GCSFileSystem(project=os.getenv('GOOGLE_PROJECT'))
+    df_todo = df if args.overwrite else filter_pending_batches(df, fs, args.flat_file_output)
+    print(f'{str(df.shape[0] - df_todo.shape[0])} batches already have per-batch files.')
+
+    if df_todo.shape[0] > 0:
+        print(f'Listing per-sample VCFs...')
+        df_todo = df_todo.assign(sample_vcfs=list_vcfs_per_batch(fs, list(df_todo.vcf)))
+
+        print(f'Reading merged VCF headers...')
+        df_todo = df_todo.assign(merged_samples=get_sample_names_from_vcfs(fs, list(df_todo.vcf)))
+
+        print(f'Generating per-batch files...')
+        if args.serial:
+            _ = produce_lists(df=df_todo, fs=fs)
+        else:
+            num_cores = multiprocessing.cpu_count()
+            chunksize = max(1, df_todo.shape[0] // (num_cores * 4))
+            print(f'Using {str(num_cores)} cores...')
+            with ProcessPoolExecutor(max_workers=num_cores, mp_context=multiprocessing.get_context('spawn'),
+                                     initializer=_init_worker) as executor:
+                results = tqdm(executor.map(_internal_list_writer, iter_batch_rows(df_todo), chunksize=chunksize), total=df_todo.shape[0])
+                tuple(results)
 
     print(f'Outputting local table with paths...')
     df.to_csv(args.table_output, sep='\t', index=False)
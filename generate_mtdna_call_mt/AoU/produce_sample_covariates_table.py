@@ -5,15 +5,14 @@ import pandas as pd
 
 def get_covariates(stats_path, covar_path, dataset=os.getenv("WORKSPACE_CDR"), 
                    ancestry_pred_path="gs://fc-aou-datasets-controlled/v6/wgs/vcf/aux/ancestry/ancestry_preds.tsv"):
-    ancestry_pred = hl.import_table(ancestry_pred_path,
-                                    key="research_id", 
-                                    impute=True, 
-                                    types={"research_id":"tstr","pca_features":hl.tarray(hl.tfloat)},
-                                    min_partitions=50)
-
     if hl.hadoop_exists(os.path.join(covar_path, '_SUCCESS')):
         sample_covariates = hl.read_table(covar_path)
     else:
+        ancestry_pred = hl.import_table(ancestry_pred_path,
+                                        key="research_id", 
+                                        impute=True, 
+                                        types={"research_id":"tstr","pca_features":hl.tarray(hl.tfloat)},
+                                        min_partitions=8)
         ht_samp_flat = hl.import_table(stats_path,
                                        key="s", 
                                        impute=True, 
@@ -21,22 +20,14 @@ def get_covariates(stats_path, covar_path, dataset=os.getenv("WORKSPACE_CDR"),
                                        min_partitions=50)
 #        ht_samp_flat = ht_samp_flat.annotate(isFemale = hl.if_else(ht_samp_flat.sex_at_birth == 'Female', 1, 
 #                                                        hl.if_else(ht_samp_flat.sex_at_birth == 'Male', 0, hl.missing(hl.tint32))))
-        ht_samp_flat = ht_samp_flat.annotate(isFemale = hl.if_else(ht_samp_flat.sex_at_birth == 'F', 1, 
-                                                        hl.if_else(ht_samp_flat.sex_at_birth == 'M', 0, hl.missing(hl.tint32))))
+        sex_map = hl.literal({'F': 1, 'M': 0})
+        ht_samp_flat = ht_samp_flat.annotate(isFemale = sex_map.get(ht_samp_flat.sex_at_birth))
 
         person_sql = f"""
-        SELECT  person.person_id,
-                person.birth_datetime,
-                p_location_concept.concept_name as loc,
-                p_site_concept.concept_name as site
+        SELECT  CAST(person.person_id AS STRING) AS person_id,
+                2021 - EXTRACT(YEAR FROM person.birth_datetime) AS approx_age
             FROM
                 `{dataset}.person` person 
-            LEFT JOIN
-                `{dataset}.concept` p_location_concept 
-                    on person.location_id = p_location_concept.CONCEPT_ID 
-            LEFT JOIN
-                `{dataset}.concept` p_site_concept 
-                    on person.care_site_id = p_site_concept.CONCEPT_ID
             WHERE
                 person.PERSON_ID IN (
                     select
@@ -60,17 +51,15 @@ def get_covariates(stats_path, covar_path, dataset=os.getenv("WORKSPACE_CDR"),
                                                 mtdna_mean_coverage = ht_samp_flat.mean_coverage, 
                                                 nucdna_mean_coverage = ht_samp_flat.nuc_mean_coverage)
         sample_covariates = sample_covariates.annotate(mtcn = 2 * sample_covariates.mtdna_mean_coverage / sample_covariates.nucdna_mean_coverage)
-        wgs_demog['approx_age'] = 2021 - pd.DatetimeIndex(wgs_demog.birth_datetime).year
-        age_table = wgs_demog[['person_id', 'approx_age']]
-        age_ht = hl.Table.from_pandas(age_table)
-        age_ht = age_ht.annotate(person_id = hl.str(age_ht.person_id)).key_by('person_id')
+        age_ht = hl.Table.from_pandas(wgs_demog, key='person_id')
         sample_covariates = sample_covariates.annotate(approx_age = age_ht[sample_covariates.s].approx_age)
         sample_covariates = sample_covariates.annotate(age_isFemale = sample_covariates.approx_age * sample_covariates.isFemale,
-                                                    age2 = sample_covariates.approx_age**2)
-        sample_covariates = sample_covariates.annotate(age2_isFemale = sample_covariates.age2 * sample_covariates.isFemale)
+                                                    age2 = sample_covariates.approx_age**2,
+                                                    age2_isFemale = (sample_covariates.approx_age**2) * sample_covariates.isFemale)
 
-        sample_covariates = sample_covariates.annotate(**{f'PC{str(idx+1)}': ancestry_pred[sample_covariates.s].pca_features[idx] for idx in range(0,10)})
-        sample_covariates = sample_covariates.annotate(pop = ancestry_pred[sample_covariates.s].ancestry_pred)
+        sample_covariates = sample_covariates.annotate(_anc = ancestry_pred[sample_covariates.s])
+        sample_covariates = sample_covariates.annotate(**{f'PC{str(idx+1)}': sample_covariates._anc.pca_features[idx] for idx in range(0,10)},
+                                                       pop = sample_covariates._anc.ancestry_pred).drop('_anc')
         sample_covariates = sample_covariates.repartition(100).checkpoint(covar_path, overwrite=True)
     return sample_covariates
 
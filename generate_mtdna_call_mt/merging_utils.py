@@ -3,26 +3,96 @@ import os
 import hail as hl
 import logging
 
-from copy import deepcopy
+from concurrent.futures import ThreadPoolExecutor
 from typing import Dict
-from hail.utils.java import info
+from hail.utils.java import FatalError, info
 from merging_constants import *
 
+# Number of threads used to issue per-file imports concurrently; imports only build IR and read
+# file headers/metadata, so this overlaps storage round trips rather than cluster compute
+IMPORT_THREADS = 16
+# Maximum number of jobs within a multi_way_union_mts stage that are checkpointed concurrently
+CHECKPOINT_THREADS = 8
 
-def multi_way_union_mts(mts: list, temp_dir: str, chunk_size: int, min_partitions: int, check_from_disk: bool, prefix: str) -> hl.MatrixTable:
+
+def successful_outputs(pattern):
+    """
+    Determine which Hail outputs matching a glob pattern contain a _SUCCESS file, using a single listing
+    call rather than one hadoop_is_file call per output.
+
+    :param pattern: Glob pattern matching output .ht/.mt paths (wildcards in the trailing path components)
+    :return: Function taking an output path and returning whether it was written successfully
+    """
+    parts = pattern.rstrip('/').split('/')
+    # number of trailing path components needed to tell matching outputs apart
+    depth = len(parts) - min((i for i, x in enumerate(parts) if '*' in x), default=len(parts) - 1)
+    try:
+        listing = hl.hadoop_ls(f'{pattern}/_SUCCESS')
+    except FileNotFoundError:
+        # nothing matches the pattern (or the parent directory does not exist yet)
+        listing = []
+    except FatalError as e:
+        # the Spark backend reports a missing path as a Java FileNotFoundException; anything else is a real failure
+        if 'FileNotFoundException' not in str(e):
+            raise
+        listing = []
+    done = {tuple(x['path'].rstrip('/').split('/')[-depth - 1:-1]) for x in listing}
+    return lambda path: tuple(path.rstrip('/').split('/')[-depth:]) in done
+
+
+def _flatten_zip_join(merged: hl.Table) -> hl.Table:
+    """
+    Flatten the nested __entries and __cols produced by multi_way_zip_join back into per-sample arrays.
+
+    :param merged: Table output of hl.Table.multi_way_zip_join(..., "__entries", "__cols")
+    :return: Table with flat __entries and __cols, ready for _unlocalize_entries
+    """
+    # Build the missing entry struct once (with the correct element type for each entry annotation, such as int32 for DP)
+    null_entry = hl.missing(merged.__entries.dtype.element_type['__entries'].element_type)
+    # Flatten __entries while taking into account different entry lengths at different samples/variants (samples lacking a variant will be NA)
+    merged = merged.annotate(
+        __entries=hl.flatten(
+            hl.range(hl.len(merged.__entries)).map(
+                # Coalesce will return the first non-missing argument, so if the entry info is not missing, use that info, but if it is missing, use a missing entries struct for each sample
+                lambda i: hl.coalesce(
+                    merged.__entries[i].__entries,
+                    hl.range(hl.len(merged.__cols[i].__cols)).map(lambda j: null_entry),
+                )
+            )
+        )
+    )
+
+    # Flatten col annotation from array<struct{__cols: array<struct{s: str}>} to array<struct{s: str}>
+    merged = merged.annotate_globals(
+        __cols=hl.flatten(merged.__cols.map(lambda x: x.__cols))
+    )
+
+    return merged
+
+
+def multi_way_union_mts(mts: list, temp_dir: str, chunk_size: int, min_partitions: int, check_from_disk: bool, prefix: str,
+                        debug_checkpoints: bool = False) -> hl.MatrixTable:
     """
     Hierarchically join together MatrixTables in the provided list.
 
     :param mts: List of MatrixTables to join together
     :param temp_dir: Path to temporary directory for intermediate results
     :param chunk_size: Number of MatrixTables to join per chunk (the number of individual VCFs that should be combined at a time)
+    :param debug_checkpoints: If True, also checkpoint each raw zip join (as *_pre.ht) before flattening when min_partitions > 10
     :return: Joined MatrixTable
     """
+    col_keys = list(mts[0].col_key)
+
     # Convert the MatrixTables to tables where entries are an array of structs
     if check_from_disk:
         staging = [x for x in mts]
     else:
         staging = [mt.localize_entries("__entries", "__cols") for mt in mts]
+
+        if 1 < len(staging) <= chunk_size:
+            # Everything fits in a single job, so join directly rather than writing (and re-reading) a stage checkpoint
+            info(f"multi_way_union_mts: merging {len(staging)} inputs in a single join")
+            staging = [_flatten_zip_join(hl.Table.multi_way_zip_join(staging, "__entries", "__cols"))]
     
     stage = 0
     while len(staging) > 1:
@@ -30,13 +100,12 @@ def multi_way_union_mts(mts: list, temp_dir: str, chunk_size: int, min_partition
         n_jobs = int(math.ceil(len(staging) / chunk_size))
         info(f"multi_way_union_mts: stage {stage}: {n_jobs} total jobs")
         
-        next_stage = []
-        
         if check_from_disk:
             all_exists = True
+            is_successful = successful_outputs(os.path.join(temp_dir, f"stage_{stage}_job_*.ht"))
             for idx in range(n_jobs):
                 path = os.path.join(temp_dir, f"stage_{stage}_job_{idx}.ht")
-                exists = hl.hadoop_is_file(f'{path}/_SUCCESS')
+                exists = is_successful(path)
                 if not exists:
                     print(path + ' is missing.')
                     if stage == 0:
@@ -46,14 +115,15 @@ def multi_way_union_mts(mts: list, temp_dir: str, chunk_size: int, min_partition
             
             if all_exists:
                 info(f"Reading stage {stage} from disk...")
-                staging.clear()
-                for idx in range(n_jobs):
-                    staging.append(hl.read_table(os.path.join(temp_dir, f"stage_{stage}_job_{idx}.ht")))
+                stage_paths = [os.path.join(temp_dir, f"stage_{stage}_job_{idx}.ht") for idx in range(n_jobs)]
+                # read_table only loads table metadata, so the reads are independent and can overlap
+                with ThreadPoolExecutor(max_workers=IMPORT_THREADS) as ex:
+                    staging = list(ex.map(hl.read_table, stage_paths))
                 info(f"Stage {stage} imported from disk.")
                 stage += 1
                 continue
 
-        for i in range(n_jobs):
+        def _run_job(i):
             # Grab just the tables for the given job
             to_merge = staging[chunk_size * i : chunk_size * (i + 1)]
             info(
@@ -62,57 +132,67 @@ def multi_way_union_mts(mts: list, temp_dir: str, chunk_size: int, min_partition
 
             # Multiway zip join will produce an __entries annotation, which is an array where each element is a struct containing the __entries annotation (array of structs) for that sample
             merged = hl.Table.multi_way_zip_join(to_merge, "__entries", "__cols")
-            if min_partitions > 10:
+            if debug_checkpoints and min_partitions > 10:
                 merged = merged.checkpoint(os.path.join(temp_dir, f"{prefix}stage_{stage}_job_{i}_pre.ht"), overwrite=True)
-            # Flatten __entries while taking into account different entry lengths at different samples/variants (samples lacking a variant will be NA)
-            merged = merged.annotate(
-                __entries=hl.flatten(
-                    hl.range(hl.len(merged.__entries)).map(
-                        # Coalesce will return the first non-missing argument, so if the entry info is not missing, use that info, but if it is missing, create an entries struct with the correct element type for each null entry annotation (such as int32 for DP)
-                        lambda i: hl.coalesce(
-                            merged.__entries[i].__entries,
-                            hl.range(hl.len(merged.__cols[i].__cols)).map(
-                                lambda j: hl.null(
-                                    merged.__entries.__entries.dtype.element_type.element_type
-                                )
-                            ),
-                        )
-                    )
-                )
-            )
+            merged = _flatten_zip_join(merged)
 
-            # Flatten col annotation from array<struct{__cols: array<struct{s: str}>} to array<struct{s: str}>
-            merged = merged.annotate_globals(
-                __cols=hl.flatten(merged.__cols.map(lambda x: x.__cols))
+            return merged.checkpoint(
+                os.path.join(temp_dir, f"{prefix}stage_{stage}_job_{i}.ht"), overwrite=True
             )
 
-            next_stage.append(
-                merged.checkpoint(
-                    os.path.join(temp_dir, f"{prefix}stage_{stage}_job_{i}.ht"), overwrite=True
-                )
-            )
+        # Each job is an independent Hail action, so submit the jobs of a stage concurrently
+        with ThreadPoolExecutor(max_workers=min(n_jobs, CHECKPOINT_THREADS)) as ex:
+            next_stage = list(ex.map(_run_job, range(n_jobs)))
         info(f"Completed stage {stage}")
         stage += 1
-        staging.clear()
-        staging.extend(next_stage)
+        # Rebind rather than copy into the old list so the previous stage can be freed
+        staging = next_stage
 
     # Unlocalize the entries, and unfilter the filtered entries and populate fields with missing values
     return (
         staging[0]
-        ._unlocalize_entries("__entries", "__cols", list(mts[0].col_key))
+        ._unlocalize_entries("__entries", "__cols", col_keys)
         .unfilter_entries()
     )
 
 
 def chunks(items, binsize):
-    lst = []
-    for item in items:
-        lst.append(item)
-        if len(lst) == binsize:
-            yield lst
-            lst = []
-    if len(lst) > 0:
-        yield lst
+    items = list(items)
+    # a binsize below 1 (e.g. fewer items than requested merges) returns everything as one chunk
+    step = binsize if binsize > 0 else max(len(items), 1)
+    return (items[i:i + step] for i in range(0, len(items), step))
+
+
+def import_coverage_mt(batch, base_level_coverage_metrics, n_read_partitions, keep_targets, no_batch_mode):
+    """
+    Import one per-base coverage file as a MatrixTable keyed by sample, ready for multi_way_union_mts.
+
+    :param batch: Batch name, annotated as the 'batch' column field; if no_batch_mode is set, the sample name used as the column key
+    :param base_level_coverage_metrics: Path to the tab-delimited per-base coverage file for this batch/sample
+    :param n_read_partitions: Minimum number of partitions to use when importing the coverage file
+    :param keep_targets: If True, keep the 'target' row field from the coverage file
+    :param no_batch_mode: If True, the coverage file holds a single sample and the column is keyed by batch rather than the file's column header
+    :return: Coverage MatrixTable with a 'coverage' entry field
+    """
+    mt = hl.import_matrix_table(
+        base_level_coverage_metrics,
+        delimiter="\t",
+        row_fields={"chrom": hl.tstr, "pos": hl.tint, "target": hl.tstr},
+        row_key=["chrom", "pos"],
+        min_partitions=n_read_partitions,
+    )
+    if not keep_targets:
+        mt = mt.drop("target")
+    else:
+        mt = mt.key_rows_by(*["chrom", "pos", "target"])
+
+    if no_batch_mode:
+        mt = mt.key_cols_by().annotate_cols(col_id = batch)
+        mt = mt.rename({"x": "coverage", 'col_id':'s'}).key_cols_by('s')
+    else:
+        mt = mt.key_cols_by().rename({"x": "coverage", 'col_id':'s'}).key_cols_by('s')
+        mt = mt.annotate_cols(batch = batch)
+    return mt
 
 
 def coverage_merging(paths, num_merges, chunk_size, check_from_disk, 
@@ -133,40 +213,26 @@ def coverage_merging(paths, num_merges, chunk_size, check_from_disk,
         else:
             subsets = chunks(pairs_for_coverage, len(pairs_for_coverage) // num_merges)
             mt_list_subsets = []
+            is_successful = successful_outputs(os.path.join(temp_dir, f'coverage_merging_subset*_{str(num_merges)}subsets', 'final_merged.mt'))
             for subset_number, subset in enumerate(subsets):
                 print(f'Importing subset {str(subset_number)}...')
                 this_prefix = f'coverage_merging_subset{str(subset_number)}_{str(num_merges)}subsets/'
                 this_subset_mt = os.path.join(temp_dir, f"{this_prefix}final_merged.mt")
-                if hl.hadoop_is_file(f'{this_subset_mt}/_SUCCESS'):
+                if is_successful(this_subset_mt):
                     mt_list_subsets.append(hl.read_matrix_table(this_subset_mt))
-                    print(f'Subset {str(subset_number)} already processed and imported with {str(mt_list_subsets[len(mt_list_subsets)-1].count_cols())} samples.')
+                    # counting samples runs a Hail job, so only do it when debug logging is on
+                    if logger.isEnabledFor(logging.DEBUG):
+                        print(f'Subset {str(subset_number)} already processed and imported with {str(mt_list_subsets[len(mt_list_subsets)-1].count_cols())} samples.')
+                    else:
+                        print(f'Subset {str(subset_number)} already processed and imported.')
                 else:
                     mt_list = []
-                    idx = 0
-                    for batch, base_level_coverage_metrics in subset:
-                        idx+=1
-                        mt = hl.import_matrix_table(
-                            base_level_coverage_metrics,
-                            delimiter="\t",
-                            row_fields={"chrom": hl.tstr, "pos": hl.tint, "target": hl.tstr},
-                            row_key=["chrom", "pos"],
-                            min_partitions=n_read_partitions,
-                        )
-                        if not keep_targets:
-                            mt = mt.drop("target")
-                        else:
-                            mt = mt.key_rows_by(*["chrom", "pos", "target"])
-
-                        if no_batch_mode:
-                            mt = mt.key_cols_by().annotate_cols(col_id = batch)
-                            mt = mt.rename({"x": "coverage", 'col_id':'s'}).key_cols_by('s')
-                        else:
-                            mt = mt.key_cols_by().rename({"x": "coverage", 'col_id':'s'}).key_cols_by('s')
-                            mt = mt.annotate_cols(batch = batch)
-
-                        mt_list.append(mt)
-                        if idx % 10 == 0:
-                            logger.info(f"Imported batch {str(idx)}, subset {str(subset_number)}...")
+                    with ThreadPoolExecutor(max_workers=IMPORT_THREADS) as ex:
+                        imported = ex.map(lambda bp: import_coverage_mt(*bp, n_read_partitions, keep_targets, no_batch_mode), subset)
+                        for idx, mt in enumerate(imported, 1):
+                            mt_list.append(mt)
+                            if idx % 10 == 0:
+                                logger.info(f"Imported batch {str(idx)}, subset {str(subset_number)}...")
 
                     logger.info(f"Joining individual coverage mts for subset {str(subset_number)}...")
                     cov_mt_this = multi_way_union_mts(mt_list, temp_dir, chunk_size, min_partitions=n_read_partitions, check_from_disk=False, prefix=this_prefix)
@@ -176,36 +242,17 @@ def coverage_merging(paths, num_merges, chunk_size, check_from_disk,
             cov_mt = cov_mt.repartition(n_final_partitions).checkpoint(this_merged_mt, overwrite=True)
     else:
         mt_list = []
-        idx = 0
         if check_from_disk:
             logger.info("NOTE: Skipping reading individual coverage MTs since --check-from-disk was enabled.")
             n_append = len(pairs_for_coverage)-1
             pairs_for_coverage = pairs_for_coverage[0:1]
         
-        for batch, base_level_coverage_metrics in pairs_for_coverage:
-            idx+=1
-            mt = hl.import_matrix_table(
-                base_level_coverage_metrics,
-                delimiter="\t",
-                row_fields={"chrom": hl.tstr, "pos": hl.tint, "target": hl.tstr},
-                row_key=["chrom", "pos"],
-                min_partitions=n_read_partitions,
-            )
-            if not keep_targets:
-                mt = mt.drop("target")
-            else:
-                mt = mt.key_rows_by(*["chrom", "pos", "target"])
-            
-            if no_batch_mode:
-                mt = mt.key_cols_by().annotate_cols(col_id = batch)
-                mt = mt.rename({"x": "coverage", 'col_id':'s'}).key_cols_by('s')
-            else:
-                mt = mt.key_cols_by().rename({"x": "coverage", 'col_id':'s'}).key_cols_by('s')
-                mt = mt.annotate_cols(batch = batch)
-
-            mt_list.append(mt)
-            if idx % 10 == 0:
-                logger.info(f"Imported batch {str(idx)}...")
+        with ThreadPoolExecutor(max_workers=IMPORT_THREADS) as ex:
+            imported = ex.map(lambda bp: import_coverage_mt(*bp, n_read_partitions, keep_targets, no_batch_mode), pairs_for_coverage)
+            for idx, mt in enumerate(imported, 1):
+                mt_list.append(mt)
+                if idx % 10 == 0:
+                    logger.info(f"Imported batch {str(idx)}...")
 
         if check_from_disk:
             mt_list.extend([None for x in range(n_append)])
@@ -230,7 +277,7 @@ def join_two_mts(mt1, mt2, row_keep, col_keep, temp_dir, partitions):
     return mt_append
 
 
-def append_coverage_to_old(cov_mt, old_mt_path, col_keep, n_final_partitions, temp_dir):
+def append_coverage_to_old(cov_mt, old_mt_path, col_keep, n_final_partitions, temp_dir, logger):
 
     this_merged_mt = os.path.join(temp_dir, 'coverage_tmp_appended_to_old_dataset_final.mt')
     cov_mt = cov_mt.checkpoint(os.path.join(temp_dir, 'coverage_mt_new_keyed_pre_merge_with_old.mt'), overwrite=True)
@@ -239,7 +286,11 @@ def append_coverage_to_old(cov_mt, old_mt_path, col_keep, n_final_partitions, te
         cov_mt = hl.read_matrix_table(this_merged_mt)
     else:
         old_mt = hl.read_matrix_table(old_mt_path)
-        print(f'Second database imported with {str(old_mt.count()[1])} samples.')
+        # counting runs a Hail job, so only do it when debug logging is on
+        if logger.isEnabledFor(logging.DEBUG):
+            print(f'Second database imported with {str(old_mt.count()[1])} samples.')
+        else:
+            print('Second database imported.')
         cov_mt = join_two_mts(mt1 = old_mt, mt2 = cov_mt, row_keep = [], col_keep = col_keep, temp_dir=temp_dir, partitions=n_final_partitions)
         cov_mt = cov_mt.repartition(n_final_partitions).checkpoint(this_merged_mt, overwrite=True) 
 
@@ -247,24 +298,30 @@ def append_coverage_to_old(cov_mt, old_mt_path, col_keep, n_final_partitions, te
 
 
 def add_coverage_annotations(cov_mt):
-    n_samples = cov_mt.count_cols()
+    # approx_median uses a bounded-memory sketch rather than collecting every sample's coverage per row,
+    # and fraction() divides by the number of samples directly, so no separate count_cols() is needed
     cov_mt = cov_mt.annotate_rows(
         mean=hl.float(hl.agg.mean(cov_mt.coverage)),
-        median=hl.median(hl.agg.collect(cov_mt.coverage)),
-        over_100=hl.float((hl.agg.count_where(cov_mt.coverage > 100) / n_samples)),
-        over_1000=hl.float((hl.agg.count_where(cov_mt.coverage > 1000) / n_samples)),
+        median=hl.float(hl.agg.approx_median(cov_mt.coverage)),
+        over_100=hl.agg.fraction(cov_mt.coverage > 100),
+        over_1000=hl.agg.fraction(cov_mt.coverage > 1000),
     )
     return cov_mt
 
 
-def append_vcf_to_old(combined_mt, old_mt_path, col_keep, n_final_partitions, temp_dir):
+def append_vcf_to_old(combined_mt, old_mt_path, col_keep, n_final_partitions, temp_dir, logger):
     this_merged_mt = os.path.join(temp_dir, 'variants_tmp_appended_to_old_dataset_final.mt')
 
     if hl.hadoop_is_file(this_merged_mt + '/_SUCCESS'):
         combined_mt = hl.read_matrix_table(this_merged_mt)
     else:
         old_mt = hl.read_matrix_table(old_mt_path)
-        print(f'Second database imported with {str(old_mt.count()[1])} samples and {str(old_mt.count()[0])} variants.')
+        # counting runs a Hail job, so only do it when debug logging is on
+        if logger.isEnabledFor(logging.DEBUG):
+            n_variants, n_samples = old_mt.count()
+            print(f'Second database imported with {str(n_samples)} samples and {str(n_variants)} variants.')
+        else:
+            print('Second database imported.')
         combined_mt = join_two_mts(mt1 = old_mt, mt2 = combined_mt, row_keep = [], col_keep = col_keep, temp_dir=temp_dir, partitions=n_final_partitions)
         combined_mt = combined_mt.repartition(n_final_partitions).checkpoint(this_merged_mt, overwrite=True) 
 
@@ -300,7 +357,7 @@ def vcf_merging_and_processing(vcf_paths, coverage_mt_path, include_extra_v2_fie
     if old_mt_path is not None:
         logger.info("Appending new VCF to old VCF database...")
         col_keep = [] if single_sample else ['batch']
-        combined_mt = append_vcf_to_old(combined_mt, old_mt_path, col_keep, n_final_partitions, temp_dir)
+        combined_mt = append_vcf_to_old(combined_mt, old_mt_path, col_keep, n_final_partitions, temp_dir, logger)
 
     logger.info("Applying artifact_prone_site filter...")
     combined_mt = apply_mito_artifact_filter(combined_mt, artifact_prone_sites_path, artifact_prone_sites_reference)
@@ -308,6 +365,86 @@ def vcf_merging_and_processing(vcf_paths, coverage_mt_path, include_extra_v2_fie
     return combined_mt, meta
 
 
+def import_vcf_mt(batch, vcf_path, include_extra_v2_fields, single_sample):
+    """
+    Import and reformat one VCF as a MatrixTable with GRCh37 loci, ready for multi_way_union_mts.
+
+    :param batch: Batch name, annotated as the 'batch' column field; if single_sample is set, the sample name used as the column key
+    :param vcf_path: Path to the VCF to import
+    :param include_extra_v2_fields: Includes extra fields important for analysis of v2.1 source MTs
+    :param single_sample: If True, the VCF holds a single sample and the column is keyed by batch rather than the VCF sample ID
+    :return: MatrixTable of the VCF keyed by GRCh37 locus and alleles
+    """
+    try:
+        mt = hl.import_vcf(vcf_path, reference_genome="GRCh38", array_elements_required=False)
+    except Exception as e:
+        raise ValueError(
+            f"vcf path {vcf_path} does not exist for sample {batch}"
+        ) from e
+
+    # Because the vcfs are split, there is only one AF value, although misinterpreted as an array because Number=A in VCF header
+    # Second value of MMQ is the value of the mapping quality for the alternate allele
+    # Add FT annotation for sample genotype filters (pull these from filters annotations of the single-sample VCFs)
+    if include_extra_v2_fields:
+        if 'GT' in mt.entry:
+            mt = mt.drop('GT')
+        
+    if single_sample:
+        if include_extra_v2_fields:
+            # process keys that are already entries
+            entry_fields = {k:v for k, v in V2_FIELD_KEY.items() if k not in V2_INFO_TO_FORMAT}
+            for x, item_type in entry_fields.items():
+                if x not in mt.entry:
+                    mt = mt.annotate_entries(**{x: hl.missing(item_type)})
+            mt = mt.select_entries("DP", "AD", *list(entry_fields.keys()), HL=mt.AF[0])
+
+            # now process info fields into entries
+            info_fields = {k:v for k, v in V2_FIELD_KEY.items() if k in V2_INFO_TO_FORMAT}
+            for x, item_type in info_fields.items():
+                if x not in mt.info:
+                    mt = mt.annotate_entries(**{x: hl.missing(item_type)})
+                else:
+                    if x in V2_INFO_TO_FORMAT_REQUIREINDEX:
+                        mt = mt.annotate_entries(**{x: mt.info[x][0]})
+                    else:
+                        mt = mt.annotate_entries(**{x: mt.info[x]})
+                    if mt.info[x].dtype == hl.dtype('tbool'):
+                        # flag is not supported in FORMAT
+                        mt = mt.annotate_entries(**{x: hl.if_else(mt.info[x], 1, 0)})
+        else:
+            mt = mt.select_entries("DP", HL=mt.AF[0])
+
+        mt = mt.annotate_entries(
+            MQ=hl.float(mt.info["MMQ"][1]),
+            TLOD=mt.info["TLOD"][0],
+            FT=hl.if_else(hl.len(mt.filters) == 0, {"PASS"}, mt.filters)
+        )
+    else:
+        if include_extra_v2_fields:
+            for x, item_type in V2_FIELD_KEY.items():
+                if x not in mt.entry:
+                    mt = mt.annotate_entries(**{x: hl.missing(item_type)})
+            
+    # enforce entry ordering (FT is last either way, so it is converted to a set in the same select)
+    if include_extra_v2_fields:
+        mt = mt.select_entries("DP", "AD", *list(V2_FIELD_KEY.keys()), "HL", "MQ", "TLOD", FT=hl.set(mt.FT))
+    else:
+        mt = mt.select_entries("DP", "HL", "MQ", "TLOD", FT=hl.set(mt.FT))
+    
+    # Use GRCh37 reference as most external resources added in downstream scripts use GRCh37 contig names
+    # (although note that the actual sequences of the mitochondria in both GRCh37 and GRCh38 are the same)
+    mt = mt.key_rows_by(
+        locus=hl.locus("MT", mt.locus.position, reference_genome="GRCh37"),
+        alleles=mt.alleles,
+    )
+    if single_sample:
+        mt = mt.key_cols_by(s=batch)
+    else:
+        mt = mt.annotate_cols(batch=batch).key_cols_by('s')
+    mt = mt.select_rows()
+    return mt
+
+
 def vcf_merging(vcf_paths: Dict[str, str], temp_dir: str, logger, n_final_partitions, 
                 chunk_size: int = 100, include_extra_v2_fields: bool = False, num_merges: int = 1,
                 single_sample: bool = False) -> hl.MatrixTable:
@@ -320,8 +457,8 @@ def vcf_merging(vcf_paths: Dict[str, str], temp_dir: str, logger, n_final_partit
     :param include_extra_v2_fields: Includes extra fields important for analysis of v2.1 source MTs
     :return: Joined MatrixTable of samples given in vcf_paths dictionary
     """
-    # Update VCF metadata
-    meta = deepcopy(META_DICT_BASE)
+    # Update VCF metadata (only the top-level sections are modified, so a shallow copy of each suffices)
+    meta = {k: dict(v) if isinstance(v, dict) else v for k, v in META_DICT_BASE.items()}
     if include_extra_v2_fields:
         meta['format'].update(META_DICT_V2_FMT)
 
@@ -332,92 +469,31 @@ def vcf_merging(vcf_paths: Dict[str, str], temp_dir: str, logger, n_final_partit
     else:
         vcf_path_list = chunks(list_paths, len(list_paths) // num_merges)
     mt_list_subsets = []
+    is_successful = successful_outputs(os.path.join(temp_dir, f'variant_merging_subset*_{str(num_merges)}subsets', 'final_merged.mt'))
     for subset_number, subset in enumerate(vcf_path_list):
         print(f'Importing subset {str(subset_number)}...')
         this_prefix = f'variant_merging_subset{str(subset_number)}_{str(num_merges)}subsets/'
         this_subset_mt = os.path.join(temp_dir, f"{this_prefix}final_merged.mt")
-        if hl.hadoop_is_file(f'{this_subset_mt}/_SUCCESS'):
+        if is_successful(this_subset_mt):
             mt_list_subsets.append(hl.read_matrix_table(this_subset_mt))
-            print(f'Subset {str(subset_number)} already processed and imported with {str(mt_list_subsets[len(mt_list_subsets)-1].count_cols())} samples.')
+            # counting samples runs a Hail job, so only do it when debug logging is on
+            if logger.isEnabledFor(logging.DEBUG):
+                print(f'Subset {str(subset_number)} already processed and imported with {str(mt_list_subsets[len(mt_list_subsets)-1].count_cols())} samples.')
+            else:
+                print(f'Subset {str(subset_number)} already processed and imported.')
         else:
+            # VCFs are imported one file at a time: hl.import_vcf with a list of paths requires every file to
+            # share the same sample columns, and the optional v2 fields present differ between files
             mt_list = []
-            idx = 0
-            for batch, vcf_path in subset:
-                idx+=1
-                try:
-                    mt = hl.import_vcf(vcf_path, reference_genome="GRCh38", array_elements_required=False)
-                except Exception as e:
-                    raise ValueError(
-                        f"vcf path {vcf_path} does not exist for sample {batch}"
-                    ) from e
-
-                # Because the vcfs are split, there is only one AF value, although misinterpreted as an array because Number=A in VCF header
-                # Second value of MMQ is the value of the mapping quality for the alternate allele
-                # Add FT annotation for sample genotype filters (pull these from filters annotations of the single-sample VCFs)
-                if include_extra_v2_fields:
-                    if 'GT' in mt.entry:
-                        mt = mt.drop('GT')
-                    
-                if single_sample:
-                    if include_extra_v2_fields:
-                        # process keys that are already entries
-                        entry_fields = {k:v for k, v in V2_FIELD_KEY.items() if k not in V2_INFO_TO_FORMAT}
-                        for x, item_type in entry_fields.items():
-                            if x not in mt.entry:
-                                mt = mt.annotate_entries(**{x: hl.missing(item_type)})
-                        mt = mt.select_entries("DP", "AD", *list(entry_fields.keys()), HL=mt.AF[0])
-
-                        # now process info fields into entries
-                        info_fields = {k:v for k, v in V2_FIELD_KEY.items() if k in V2_INFO_TO_FORMAT}
-                        for x, item_type in info_fields.items():
-                            if x not in mt.info:
-                                mt = mt.annotate_entries(**{x: hl.missing(item_type)})
-                            else:
-                                if x in V2_INFO_TO_FORMAT_REQUIREINDEX:
-                                    mt = mt.annotate_entries(**{x: mt.info[x][0]})
-                                else:
-                                    mt = mt.annotate_entries(**{x: mt.info[x]})
-                                if mt.info[x].dtype == hl.dtype('tbool'):
-                                    # flag is not supported in FORMAT
-                                    mt = mt.annotate_entries(**{x: hl.if_else(mt.info[x], 1, 0)})
-                    else:
-                        mt = mt.select_entries("DP", HL=mt.AF[0])
-
-                    mt = mt.annotate_entries(
-                        MQ=hl.float(mt.info["MMQ"][1]),
-                        TLOD=mt.info["TLOD"][0],
-                        FT=hl.if_else(hl.len(mt.filters) == 0, {"PASS"}, mt.filters)
-                    )
-                else:
-                    if include_extra_v2_fields:
-                        for x, item_type in V2_FIELD_KEY.items():
-                            if x not in mt.entry:
-                                mt = mt.annotate_entries(**{x: hl.missing(item_type)})
-                        
-                # enforce entry ordering
-                if include_extra_v2_fields:
-                    mt = mt.select_entries("DP", "AD", *list(V2_FIELD_KEY.keys()), "HL", "MQ", "TLOD", "FT")
-                else:
-                    mt = mt.select_entries("DP", "HL", "MQ", "TLOD", "FT")
-                
-                # Use GRCh37 reference as most external resources added in downstream scripts use GRCh37 contig names
-                # (although note that the actual sequences of the mitochondria in both GRCh37 and GRCh38 are the same)
-                mt = mt.annotate_entries(FT = hl.set(mt.FT))
-                mt = mt.key_rows_by(
-                    locus=hl.locus("MT", mt.locus.position, reference_genome="GRCh37"),
-                    alleles=mt.alleles,
-                )
-                if single_sample:
-                    mt = mt.key_cols_by(s=batch)
-                else:
-                    mt = mt.annotate_cols(batch=batch).key_cols_by('s')
-                mt = mt.select_rows()
-                mt_list.append(mt)
-                if idx % 20 == 0:
-                    if single_sample:
-                        logger.info(f"Imported sample {str(idx)}...")
-                    else:    
-                        logger.info(f"Imported batch {str(idx)}...")
+            with ThreadPoolExecutor(max_workers=IMPORT_THREADS) as ex:
+                imported = ex.map(lambda bp: import_vcf_mt(*bp, include_extra_v2_fields, single_sample), subset)
+                for idx, mt in enumerate(imported, 1):
+                    mt_list.append(mt)
+                    if idx % 20 == 0:
+                        if single_sample:
+                            logger.info(f"Imported sample {str(idx)}...")
+                        else:    
+                            logger.info(f"Imported batch {str(idx)}...")
 
             combined_mt_this = multi_way_union_mts(mt_list, temp_dir, chunk_size, min_partitions=1, check_from_disk=False, prefix=this_prefix)
             combined_mt_this = combined_mt_this.repartition(n_final_partitions // num_merges).checkpoint(this_subset_mt, overwrite=True)
@@ -448,8 +524,6 @@ def collect_vcf_paths(participant_data: str, vcf_col_name: str, participants_to_
     :param participants_to_subset: Path to file of participant_ids to which the data should be subset
     :return: Dictionary with sample name as key and path to VCF as value
     """
-    vcf_paths = {}
-    
     # Load in data
     if os.path.splitext(participant_data)[1] == '.ht':
         participant_ht = hl.read_table(participant_data)
@@ -457,27 +531,25 @@ def collect_vcf_paths(participant_data: str, vcf_col_name: str, participants_to_
         participant_ht = hl.import_table(participant_data)
     
     # Remove participants that don't have VCF output
-    participant_ht.filter(participant_ht[vcf_col_name] != "")
+    participant_ht = participant_ht.filter(participant_ht[vcf_col_name] != "")
 
     # Subset participants if specified
     if participants_to_subset:
         participants_of_interest = hl.import_table(
             participants_to_subset
         ).participant.collect()
+        # Use a set literal so membership is a hash lookup rather than a scan over the list
+        participants_of_interest = hl.literal(set(participants_of_interest), dtype=hl.tset(hl.tstr))
         participant_ht = participant_ht.filter(
-            hl.literal(participants_of_interest).contains(
+            participants_of_interest.contains(
                 participant_ht["entity:participant_id"]
             )
         )
 
-    # Add the vcf path to a dictionary with batch name as key
-    df = participant_ht.to_pandas()
-
-    for _, row in df.iterrows():
-        if single_sample:
-            vcf_paths[row["s"]] = row[vcf_col_name]
-        else:
-            vcf_paths[row["batch"]] = row[vcf_col_name]
+    # Add the vcf path to a dictionary with batch name (or sample name if single_sample) as key
+    key_expr = participant_ht.s if single_sample else participant_ht.batch
+    rows = participant_ht.select(k=key_expr, v=participant_ht[vcf_col_name]).collect()
+    vcf_paths = {row.k: row.v for row in rows}
 
     return vcf_paths
 
@@ -529,19 +601,17 @@ def determine_hom_refs(mt: hl.MatrixTable, coverage_mt_path: str, minimum_homref
         locus=hl.locus("MT", coverages.locus.position, reference_genome="GRCh37")
     )
 
-    mt = mt.annotate_entries(
-        DP=hl.if_else(hl.is_missing(mt.HL), coverages[mt.locus, mt.s].coverage, mt.DP)
-    )
-
-    hom_ref_expr = hl.is_missing(mt.HL) & (mt.DP > minimum_homref_coverage)
+    # Compute the coverage-backfilled DP once and derive all updated entry fields from it in a single annotation
+    new_dp = hl.if_else(hl.is_missing(mt.HL), coverages[mt.locus, mt.s].coverage, mt.DP)
+    hom_ref_expr = hl.is_missing(mt.HL) & (new_dp > minimum_homref_coverage)
 
     mt = mt.annotate_entries(
         HL=hl.if_else(hom_ref_expr, 0.0, mt.HL),
         FT=hl.if_else(hom_ref_expr, {"PASS"}, mt.FT),
         DP=hl.if_else(
-            hl.is_missing(mt.HL) & (mt.DP <= minimum_homref_coverage),
+            hl.is_missing(mt.HL) & (new_dp <= minimum_homref_coverage),
             hl.null(hl.tint32),
-            mt.DP,
+            new_dp,
         ),
     )
 
@@ -568,62 +638,29 @@ def apply_mito_artifact_filter(mt: hl.MatrixTable, artifact_prone_sites_path: st
                                                       hl.locus('MT',bed.interval.end.position, reference_genome='GRCh37'))).key_by('interval')
     else:
         bed = hl.import_bed(artifact_prone_sites_path)
-    bed = bed.annotate(target="artifact")
-
-    # Create a region annotation containing the interval that the variant overlaps (for SNP will be one position, but will be longer for deletions based on the length of the deletion)
-    mt = mt.annotate_rows(
-        region=hl.interval(
-            hl.locus("MT", mt.locus.position, reference_genome="GRCh37"),
-            hl.locus(
-                "MT",
-                mt.locus.position + hl.len(mt.alleles[0]) - 1,
-                reference_genome="GRCh37",
-            ),
-            includes_end=True,
-        )
-    )
-
-    # Annotate if the start of the variant overlaps an interval in the bed file
-    mt = mt.annotate_rows(start_overlaps=bed.index(mt.region.start, all_matches=True))
 
-    # Annotate if the end of the variant overlaps an interval in the bed file
-    mt = mt.annotate_rows(end_overlaps=bed.index(mt.region.end, all_matches=True))
-
-    # Create struct containing locus and allele (need to the check if any position of the allele overlaps an artifact-prone site, not just the locus)
-    mt_temp = mt.annotate_rows(variant=hl.struct(locus=mt.locus, alleles=mt.alleles))
-    mt_temp = mt_temp.key_rows_by(mt_temp.region)
-
-    # Need to account for cases where the start and end of the variant interval don't fall within a bed interval, but start before and after the interval (the bed interval falls completely within the variant interval)
-    bed_temp = bed.annotate(
-        contained_mt_alleles=mt_temp.index_rows(
-            bed.interval.start, all_matches=True
-        ).variant
-    )
-
-    # Explode so that each allele is on its own row and create locus and allele annotations
-    bed_temp = bed_temp.explode(bed_temp.contained_mt_alleles).rename(
-        {"contained_mt_alleles": "contained_mt_allele"}
-    )
-    bed_temp = bed_temp.annotate(
-        locus=bed_temp.contained_mt_allele.locus,
-        alleles=bed_temp.contained_mt_allele.alleles,
+    # The artifact-prone site BED is small, so collect it to the driver and scan it as a literal for each row rather than joining against it
+    bed_intervals = hl.literal(bed.interval.collect(), dtype=hl.tarray(bed.interval.dtype))
+
+    # Create a region expression containing the interval that the variant overlaps (for SNP will be one position, but will be longer for deletions based on the length of the deletion)
+    # mt.locus is already an MT locus on GRCh37 (set in import_vcf_mt), so it is used directly as the start
+    region = hl.interval(
+        mt.locus,
+        hl.locus(
+            "MT",
+            mt.locus.position + hl.len(mt.alleles[0]) - 1,
+            reference_genome="GRCh37",
+        ),
+        includes_end=True,
     )
-    bed_temp = bed_temp.key_by(bed_temp.locus, bed_temp.alleles)
-
-    # Annotate back onto the original mt cases where the bed interval falls completely within the variant interval
-    mt = mt.annotate_rows(start_and_end_span=bed_temp[mt.locus, mt.alleles].target)
 
     # Add artifact-prone site filter to any SNP/deletion that starts within, ends within, or completely overlaps an artifact-prone site
     mt = mt.annotate_rows(
         filters=hl.if_else(
-            (hl.len(mt.start_overlaps) > 0)
-            | (hl.len(mt.end_overlaps) > 0)
-            | (hl.is_defined(mt.start_and_end_span)),
+            hl.any(lambda interval: interval.overlaps(region), bed_intervals),
             {"artifact_prone_site"},
             {"PASS"},
         )
     )
 
-    mt = mt.drop("region", "start_overlaps", "end_overlaps", "start_and_end_span")
-
     return mt